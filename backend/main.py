@@ -1,13 +1,18 @@
+import asyncio
 import os
-import math
 import re
-from collections import defaultdict
+import time
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
 
+import numpy as np
+import orjson
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from bson import ObjectId
+from pymongo import AsyncMongoClient
 
 # ------------------ Config & setup ------------------ #
 
@@ -16,19 +21,56 @@ load_dotenv()  # load .env from project root
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "basic_search_engine")
 
+# Seconds between checks for a newly built index (see load_snapshot)
+INDEX_REFRESH_SECONDS = int(os.getenv("INDEX_REFRESH_SECONDS", "60"))
+
+# Query terms found in more than this fraction of documents are dropped
+# before scoring (unless that would drop every term), because their postings
+# are the longest to score. This is lossy: it trades ranking fidelity for
+# speed. At 0.5 a dropped term still has an idf up to ln 2 (~0.69), so docs
+# with both query terms tie with docs that only have the rarer one. Docs that
+# only match a dropped term aren't candidates at all, so when the remaining
+# terms find fewer than limit docs the query is ranked again with every term.
+# Set it above 1 to disable the pruning.
+HIGH_DF_RATIO = float(os.getenv("HIGH_DF_RATIO", "0.5"))
+
+# Seconds a cached $text result set stays valid (pages change with every crawl)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_SIZE = 1024
+
+# Rank with MongoDB's native $text index on pages instead of our TF-IDF postings
+USE_MONGO_TEXT = os.getenv("USE_MONGO_TEXT", "").lower() in ("1", "true", "yes")
+
 if not MONGO_URI:
     raise RuntimeError("MONGO_URI is not set in .env")
 
-client = MongoClient(MONGO_URI)
+client = AsyncMongoClient(MONGO_URI)
 db = client[MONGO_DB_NAME]
 
+PAGES_COLL = db["pages"]
 DOCS_COLL = db["documents"]
 INDEX_COLL = db["index_terms"]
+INDEX_META_COLL = db["index_meta"]
+
+# Must match the indexer: posting columns are zlib-compressed little-endian int32.
+POSTING_DTYPE = np.dtype("<i4")
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response rendered by orjson (Rust) instead of the stdlib encoder.
+    Anything orjson can't serialize natively (e.g. ObjectId) goes through str().
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str)
+
 
 app = FastAPI(
     title="Mini Search Engine API",
     description="Simple TF-IDF based search API",
     version="0.1.0",
+    default_response_class=ORJSONResponse,
 )
 
 # Allow your frontend (Vercel) to call the API.
@@ -43,68 +85,287 @@ app.add_middleware(
 
 # ------------------ Tokenization (same as indexer) ------------------ #
 
-STOPWORDS = {
+STOPWORDS = frozenset({
     "the", "is", "in", "at", "of", "a", "an", "and", "or", "to", "for",
     "on", "with", "by", "this", "that", "it", "as", "are", "was", "were",
     "be", "from", "which", "into", "about", "can", "will", "has", "have",
     "had", "you", "your", "we", "they", "their", "our", "not"
-}
+})
 
-TOKEN_RE = re.compile(r"[a-zA-Z0-9]+")
+# Length filter lives in the pattern so findall already drops short tokens.
+TOKEN_RE = re.compile(r"[a-z0-9]{3,}")
 
 
 def tokenize(text: str):
-    text = text.lower()
-    tokens = TOKEN_RE.findall(text)
-    tokens = [t for t in tokens if len(t) > 2 and t not in STOPWORDS]
-    return tokens
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
 
 
 # ------------------ Search logic ------------------ #
 
-def search_query(q: str, limit: int = 20):
-    terms = tokenize(q)
-    if not terms:
-        return []
+# 1 + ln(tf) for every tf below 65536 (0 for tf == 0), so the per-posting
+# log becomes a table gather; larger tfs are rare and computed directly.
+# Scoring runs in float32: half the bytes per posting, and TF-IDF ranking
+# doesn't need more precision.
+TF_WEIGHTS = np.concatenate(([0.0], 1.0 + np.log(np.arange(1, 65536)))).astype(np.float32)
+
+
+def tf_weights(tfs: np.ndarray) -> np.ndarray:
+    weights = TF_WEIGHTS[np.minimum(tfs, len(TF_WEIGHTS) - 1)]
+    large = tfs >= len(TF_WEIGHTS)
+    if large.any():
+        weights[large] = 1.0 + np.log(tfs[large])
+    return weights
+
+
+# In-memory copy of the whole index, tagged with the version the indexer
+# published in index_meta. Replaced wholesale on reload. Postings of all terms
+# are concatenated into doc_ids / impacts (each term's slice sorted by
+# doc_id, impacts being the (1 + ln tf) * idf a posting adds to its doc's
+# score); terms maps term -> (start, end, idf, max score).
+_snapshot = {
+    "version": None,
+    "checked_at": None,
+    "terms": {},
+    "doc_ids": np.empty(0, dtype=POSTING_DTYPE),
+    "impacts": np.empty(0, dtype=np.float32),
+    "num_docs": 0,
+    "docs": {},
+    "high_df": frozenset(),
+}
 
-    index_docs = list(INDEX_COLL.find({"term": {"$in": terms}}))
-    if not index_docs:
-        return []
 
-    scores = defaultdict(float)
+# Only one reload at a time; other requests keep using the current snapshot.
+_reload_lock = asyncio.Lock()
 
-    for term_doc in index_docs:
-        term = term_doc["term"]
-        idf = term_doc.get("idf", 0.0)
-        for posting in term_doc.get("docs", []):
-            doc_id = posting["doc_id"]
-            tf = posting["tf"]
-            score = (1.0 + math.log(tf)) * idf if tf > 0 else 0.0
-            scores[doc_id] += score
 
-    if not scores:
-        return []
+async def load_snapshot():
+    """
+    Return the current snapshot, reloading it if the indexer has published
+    a new version since the last check (at most every INDEX_REFRESH_SECONDS).
+    """
+    global _snapshot
+
+    now = time.monotonic()
+    checked_at = _snapshot["checked_at"]
+    if checked_at is not None and (
+        now - checked_at < INDEX_REFRESH_SECONDS or _reload_lock.locked()
+    ):
+        return _snapshot
+
+    async with _reload_lock:
+        if _snapshot["checked_at"] is not checked_at:
+            # Another request reloaded while we waited for the lock.
+            return _snapshot
+
+        try:
+            meta = await INDEX_META_COLL.find_one({"_id": "current"}) or {}
+            version = meta.get("version")
+            # Never load while a rebuild has the collections half-written: keep
+            # serving the previous index (or, on a cold start, nothing yet) and
+            # check again after INDEX_REFRESH_SECONDS.
+            if _index_unusable(meta) or (checked_at is not None and version == _snapshot["version"]):
+                _snapshot["checked_at"] = now
+                return _snapshot
+
+            # Postings and metadata are independent reads; fetch them concurrently.
+            term_docs, docs = await asyncio.gather(_fetch_term_docs(), _load_docs())
+            # A rebuild may have started (or finished) while we were reading,
+            # leaving us with a mix of old and new collections. Only install
+            # what we fetched if index_meta still describes it.
+            after = await INDEX_META_COLL.find_one({"_id": "current"}) or {}
+            if _index_unusable(after) or after.get("version") != version:
+                print("Index changed while loading the snapshot, keeping the current one")
+                _snapshot["checked_at"] = now
+                return _snapshot
+
+            # Decoding and scoring every posting is CPU work; keep it off the
+            # event loop so in-flight searches aren't stalled by a reload.
+            terms, doc_ids, impacts, high_df = await asyncio.to_thread(
+                _build_postings, term_docs, HIGH_DF_RATIO * len(docs)
+            )
+        except Exception as e:
+            if checked_at is None:
+                raise
+            # A good snapshot is already in memory: keep serving it and retry
+            # after the next interval instead of on every request.
+            print("Failed to refresh the index snapshot, keeping the current one:", e)
+            _snapshot["checked_at"] = now
+            return _snapshot
+
+        _snapshot = {
+            "version": version,
+            "checked_at": now,
+            "terms": terms,
+            "doc_ids": doc_ids,
+            "impacts": impacts,
+            "num_docs": int(doc_ids.max()) + 1 if len(doc_ids) else 0,
+            "docs": docs,
+            "high_df": high_df,
+        }
+        return _snapshot
+
 
-    sorted_docs = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    top_docs = sorted_docs[:limit]
+def _index_unusable(meta: dict) -> bool:
+    """
+    True if index_meta says the index collections can't be loaded right now:
+    a build is rewriting them, or the last one died part way through.
+    """
+    if meta.get("failed"):
+        print("The last index build failed, not loading the index:", meta["failed"])
+        return True
+    if meta.get("building"):
+        print("An index build is in progress, not loading the index yet")
+        return True
+    return False
+
+
+async def _fetch_term_docs():
+    cursor = INDEX_COLL.find({}, {"_id": 0, "term": 1, "idf": 1, "doc_ids": 1, "tfs": 1})
+    return [term_doc async for term_doc in cursor]
+
+
+def _build_postings(term_docs: list, max_df: float):
+    """
+    Decode the compressed posting columns into the snapshot arrays. Returns
+    (terms, doc_ids, impacts, high_df). Runs in a worker thread.
+    """
+    terms = {}
+    doc_ids = []
+    tfs = []
+    offset = 0
+    for term_doc in term_docs:
+        # Columns are zlib-compressed; doc_ids hold gaps between sorted ids.
+        gaps = np.frombuffer(zlib.decompress(term_doc["doc_ids"]), dtype=POSTING_DTYPE)
+        ids = np.cumsum(gaps, dtype=np.int32)
+        terms[term_doc["term"]] = (offset, offset + len(ids), term_doc.get("idf", 0.0))
+        doc_ids.append(ids)
+        tfs.append(np.frombuffer(zlib.decompress(term_doc["tfs"]), dtype=POSTING_DTYPE))
+        offset += len(ids)
+
+    if not doc_ids:
+        return terms, np.empty(0, dtype=POSTING_DTYPE), np.empty(0, dtype=np.float32), frozenset()
+    doc_ids = np.concatenate(doc_ids)
+
+    # Score every posting once here instead of on every query: a search then
+    # only sums precomputed impacts.
+    #
+    # Each term also gets its max per-document score, the upper bound MaxScore
+    # pruning relies on. Taken from the impacts themselves, so the bound can
+    # never undershoot a real score. Terms with idf <= 0 can only lower a
+    # score, so their bound is 0.
+    impacts = tf_weights(np.concatenate(tfs))
+    for term, (start, end, idf) in terms.items():
+        impacts[start:end] *= np.float32(idf)
+        bound = float(impacts[start:end].max()) if idf > 0 else 0.0
+        terms[term] = (start, end, idf, bound)
+
+    # A term's df is the length of its posting list.
+    high_df = frozenset(
+        term for term, (start, end, *_) in terms.items() if end - start > max_df
+    )
+    return terms, doc_ids, impacts, high_df
 
-    doc_ids = [doc_id for doc_id, _ in top_docs]
-    normalized_ids = [ObjectId(d) if not isinstance(d, ObjectId) else d for d in doc_ids]
 
-    # IMPORTANT: fetch new metadata fields
+async def _load_docs():
     docs_cursor = DOCS_COLL.find(
-        {"_id": {"$in": normalized_ids}},
+        {},
         {
+            "page_id": 1,
             "url": 1,
             "title": 1,
             "snippet": 1,
-            "favicon": 1,       # NEW
-            "image": 1,         # NEW
-            "site_name": 1      # NEW
+            "favicon": 1,
+            "image": 1,
+            "site_name": 1
         }
     )
+    return {doc["_id"]: doc async for doc in docs_cursor}
+
+
+def _result(page_id, meta: dict, score: float) -> dict:
+    """
+    Shape of one search hit, shared by the postings and $text paths.
+    """
+    return {
+        "id": str(page_id),
+        "url": meta.get("url", ""),
+        "title": meta.get("title", "") or meta.get("url", ""),
+        "snippet": meta.get("snippet", ""),
+        "favicon": meta.get("favicon", ""),
+        "image": meta.get("image", ""),
+        "site_name": meta.get("site_name", ""),
+        "score": score,
+    }
+
+
+async def search_query(q: str, limit: int = 20):
+    terms = tokenize(q)
+    if not terms or limit < 1:
+        return []
+
+    # Term order and repeats don't change the score, so normalize before keying
+    # the cache. Postings results only change when a new index is published;
+    # $text results follow the live pages collection and expire by time.
+    if USE_MONGO_TEXT:
+        results = await _text_results(tuple(sorted(set(terms))), limit)
+    else:
+        snapshot = await load_snapshot()
+        # Terms missing from the index can't score: drop them so "python xyzzy"
+        # shares a cache entry with "python", and skip ranking when none is left.
+        key = tuple(sorted({t for t in terms if t in snapshot["terms"]}))
+        if not key:
+            return []
+        results = _ranked_results(key, limit, snapshot["version"])
+    return [dict(r) for r in results]
+
+
+# (terms, limit, time bucket) -> results, least recently used first
+_text_cache = OrderedDict()
+
+
+async def _text_results(terms: tuple, limit: int) -> tuple:
+    cache_key = (terms, limit, int(time.time() // SEARCH_CACHE_TTL))
+    if cache_key in _text_cache:
+        _text_cache.move_to_end(cache_key)
+        return _text_cache[cache_key]
+
+    # Candidate generation and scoring both happen in MongoDB's text index.
+    cursor = PAGES_COLL.find(
+        {"$text": {"$search": " ".join(terms)}},
+        {
+            "score": {"$meta": "textScore"},
+            "url": 1,
+            "title": 1,
+            "snippet": 1,
+            "favicon": 1,
+            "image": 1,
+            "site_name": 1
+        }
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+
+    results = [
+        _result(page["_id"], page, page.get("score", 0.0)) async for page in cursor
+    ]
+
+    _text_cache[cache_key] = tuple(results)
+    if len(_text_cache) > SEARCH_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return _text_cache[cache_key]
+
 
-    docs_by_id = {doc["_id"]: doc for doc in docs_cursor}
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _ranked_results(terms: tuple, limit: int, version) -> tuple:
+    # Ranks against the snapshot search_query just loaded (version only keys
+    # the cache). Pure in-memory work: nothing here awaits.
+    snapshot = _snapshot
+    kept = [t for t in terms if t not in snapshot["high_df"]]
+    top_docs = _top_docs(snapshot, kept or terms, limit)
+    if kept and len(kept) < len(terms) and len(top_docs) < limit:
+        # Docs matching only the dropped terms were never candidates, and the
+        # kept terms didn't fill the page: rank again with every term.
+        top_docs = _top_docs(snapshot, terms, limit)
+
+    docs_by_id = snapshot["docs"]
 
     results = []
     for doc_id, score in top_docs:
@@ -112,40 +373,87 @@ def search_query(q: str, limit: int = 20):
         if not meta:
             continue
 
-        results.append({
-            "id": str(doc_id),
-            "url": meta.get("url", ""),
-            "title": meta.get("title", "") or meta.get("url", ""),
-            "snippet": meta.get("snippet", ""),
+        results.append(_result(meta.get("page_id", doc_id), meta, score))
 
-            # NEW fields
-            "favicon": meta.get("favicon", ""),
-            "image": meta.get("image", ""),
-            "site_name": meta.get("site_name", ""),
+    return tuple(results)
 
-            "score": score,
-        })
 
-    return results
+def _top_docs(snapshot: dict, terms, limit: int) -> list:
+    """
+    Top `limit` (doc_id, score) pairs for the terms, best first.
+    """
+    spans = [snapshot["terms"][t] for t in terms if t in snapshot["terms"]]
+    if not spans:
+        return []
+
+    # doc_ids are the indexer's dense 0..N-1 ids and index straight into a
+    # score array. Per-term work below only touches that term's postings and
+    # the ids seen so far, never the whole corpus.
+    doc_ids = snapshot["doc_ids"]
+    impacts = snapshot["impacts"]
+    scores = np.zeros(snapshot["num_docs"])
+    seen = np.zeros(snapshot["num_docs"], dtype=bool)
+    seen_ids = np.empty(0, dtype=POSTING_DTYPE)
+
+    # MaxScore: add terms from the highest possible contribution down. Once
+    # the k-th best score so far beats everything the remaining terms could
+    # add, documents not seen yet can't reach the top-k, so the remaining
+    # (low-impact, usually longest) lists are only probed for the surviving
+    # candidates by binary search over their sorted doc_ids.
+    spans.sort(key=lambda span: span[3], reverse=True)
+    remaining = sum(bound for *_, bound in spans)
+    for i, (start, end, _, bound) in enumerate(spans):
+        # Negative-idf terms could still pull the current k-th score down.
+        if 0 < limit <= len(seen_ids) and all(span[2] >= 0 for span in spans[i:]):
+            seen_scores = scores[seen_ids]
+            kth = len(seen_ids) - limit
+            threshold = np.partition(seen_scores, kth)[kth]
+            if remaining < threshold:
+                seen_ids = seen_ids[seen_scores + remaining >= threshold]
+                for start, end, *_ in spans[i:]:
+                    ids = doc_ids[start:end]
+                    pos = np.minimum(np.searchsorted(ids, seen_ids), len(ids) - 1)
+                    found = ids[pos] == seen_ids
+                    scores[seen_ids[found]] += impacts[start:end][pos[found]]
+                break
+
+        ids = doc_ids[start:end]
+        # A doc appears at most once per posting list, so a fancy-indexed add
+        # is safe here.
+        scores[ids] += impacts[start:end]
+        new_ids = ids[~seen[ids]]
+        seen[new_ids] = True
+        seen_ids = np.concatenate((seen_ids, new_ids))
+        remaining -= bound
+
+    # Only documents with at least one posting are hits, whatever their score.
+    candidates = seen_ids
+    if len(candidates) > limit:
+        keep = np.argpartition(-scores[candidates], limit - 1)[:limit]
+        candidates = candidates[keep]
+    top = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    return [(int(doc_id), float(scores[doc_id])) for doc_id in top]
 
 
 
 # ------------------ API endpoints ------------------ #
 
 @app.get("/search")
-def search(q: str = Query(..., description="Search query"), limit: int = 20):
+async def search(q: str = Query(..., description="Search query"), limit: int = 20):
     """
     Search endpoint.
     Example: GET /search?q=python
     """
-    results = search_query(q, limit=limit)
-    return {
+    results = await search_query(q, limit=limit)
+    # Returning the response directly skips FastAPI's jsonable_encoder pass.
+    return ORJSONResponse({
         "query": q,
         "count": len(results),
         "results": results,
-    }
+    })
 
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Mini Search Engine API. Use /search?q=your+query"}
@@ -0,0 +1,106 @@
+import math
+import os
+import random
+import zlib
+
+import numpy as np
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+import main  # noqa: E402  (needs MONGO_URI; the client connects lazily)
+
+
+def build_snapshot(postings: dict, num_docs: int, max_df: float = float("inf")):
+    """
+    Pack term -> {doc_id: tf} the way indexer.py does and load it through
+    the API's own decoding, so the test covers the real snapshot layout.
+    """
+    term_docs = []
+    for term, docs in postings.items():
+        doc_ids = np.asarray(sorted(docs), dtype=main.POSTING_DTYPE)
+        tfs = np.asarray([docs[d] for d in doc_ids], dtype=main.POSTING_DTYPE)
+        idf = math.log(num_docs / (1 + len(docs)))
+        term_docs.append({
+            "term": term,
+            "idf": float(np.float32(idf)),
+            "doc_ids": zlib.compress(np.diff(doc_ids, prepend=0).astype(main.POSTING_DTYPE).tobytes()),
+            "tfs": zlib.compress(tfs.tobytes()),
+        })
+
+    terms, doc_ids, impacts, high_df = main._build_postings(term_docs, max_df)
+    return {
+        "version": object(),
+        "checked_at": 0.0,
+        "terms": terms,
+        "doc_ids": doc_ids,
+        "impacts": impacts,
+        "num_docs": num_docs,
+        "docs": {d: {"page_id": d, "url": f"http://example.com/{d}"} for d in range(num_docs)},
+        "high_df": high_df,
+    }
+
+
+def brute_force(postings: dict, terms: tuple, num_docs: int) -> dict:
+    """
+    Full TF-IDF score of every document matching any of the terms.
+    """
+    scores = {}
+    for term in terms:
+        idf = math.log(num_docs / (1 + len(postings[term])))
+        for doc_id, tf in postings[term].items():
+            scores[doc_id] = scores.get(doc_id, 0.0) + (1.0 + math.log(tf)) * idf
+    return scores
+
+
+def test_max_score_pruning_matches_brute_force(monkeypatch):
+    rng = random.Random(7)
+    num_docs = 400
+    vocab = [f"term{i}" for i in range(30)]
+
+    # Zipf-ish document frequencies, including terms in every document
+    # (negative idf) so the pruning guard for those is exercised too.
+    postings = {}
+    for rank, term in enumerate(vocab):
+        df = num_docs if rank < 2 else max(1, int(num_docs / (rank + 1) ** 1.1))
+        postings[term] = {
+            d: int(rng.paretovariate(1.5))
+            for d in rng.sample(range(num_docs), df)
+        }
+
+    monkeypatch.setattr(main, "_snapshot", build_snapshot(postings, num_docs))
+    rank = main._ranked_results.__wrapped__
+
+    for _ in range(500):
+        terms = tuple(sorted(rng.sample(vocab, rng.randint(1, 6))))
+        limit = rng.randint(1, 25)
+
+        hits = rank(terms, limit, None)
+        full = brute_force(postings, terms, num_docs)
+        expected = sorted(full.values(), reverse=True)[:limit]
+
+        assert len(hits) == len(expected), terms
+        assert np.allclose([hit["score"] for hit in hits], expected, rtol=1e-4, atol=1e-4), (terms, limit)
+        # Ties can hide a candidate that was pruned with a partial score, so
+        # every hit must also carry its document's full score.
+        for hit in hits:
+            assert math.isclose(hit["score"], full[int(hit["id"])], rel_tol=1e-4, abs_tol=1e-4), (terms, limit, hit["id"])
+
+
+def test_high_df_pruning_still_fills_the_page(monkeypatch):
+    # "python" is in 10 of 12 docs and gets dropped as high-df; "tutorial"
+    # alone only finds 2, so the rest of the page has to come from "python".
+    postings = {
+        "python": {d: 1 + d % 3 for d in range(10)},
+        "tutorial": {3: 1, 11: 2},
+    }
+    num_docs = 12
+    monkeypatch.setattr(main, "_snapshot", build_snapshot(postings, num_docs, max_df=0.5 * num_docs))
+    assert main._snapshot["high_df"] == {"python"}
+
+    hits = main._ranked_results.__wrapped__(("python", "tutorial"), 5, None)
+
+    full = brute_force(postings, ("python", "tutorial"), num_docs)
+    assert len(hits) == 5
+    assert [hit["score"] for hit in hits] == sorted((hit["score"] for hit in hits), reverse=True)
+    for hit in hits:
+        assert math.isclose(hit["score"], full[int(hit["id"])], rel_tol=1e-4, abs_tol=1e-4)
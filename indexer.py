@@ -1,8 +1,12 @@
 import os
 import re
 import math
-from collections import defaultdict, Counter
+import zlib
+import multiprocessing as mp
+from collections import Counter
 
+import numpy as np
+from bson import Binary, ObjectId
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from pymongo.errors import PyMongoError
@@ -17,33 +21,90 @@ MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "basic_search_engine")
 if not MONGO_URI:
     raise RuntimeError("MONGO_URI is not set in .env")
 
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB_NAME]
-
-PAGES_COLL = db["pages"]
-DOCS_COLL = db["documents"]
-INDEX_COLL = db["index_terms"]
+# On-disk dtype of the packed doc_ids / tfs posting arrays (see backend/main.py)
+POSTING_DTYPE = np.dtype("<i4")
 
 # ------------------ Tokenization ------------------ #
 
-STOPWORDS = {
+STOPWORDS = frozenset({
     "the", "is", "in", "at", "of", "a", "an", "and", "or", "to", "for",
     "on", "with", "by", "this", "that", "it", "as", "are", "was", "were",
     "be", "from", "which", "into", "about", "can", "will", "has", "have",
     "had", "you", "your", "we", "they", "their", "our", "not", "how"
-}
+})
 
-TOKEN_RE = re.compile(r"[a-zA-Z0-9]+")
+# Length filter lives in the pattern so findall already drops short tokens.
+TOKEN_RE = re.compile(r"[a-z0-9]{3,}")
 
 def tokenize(text: str):
-    text = (text or "").lower()
-    tokens = TOKEN_RE.findall(text)
-    tokens = [t for t in tokens if len(t) > 2 and t not in STOPWORDS]
-    return tokens
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if t not in STOPWORDS]
 
 # ------------------ Index building ------------------ #
 
+def process_page(page):
+    """
+    Tokenize one page. Returns (length, term counts, metadata), or None
+    if the page should not be indexed. Runs in a worker process.
+    """
+    try:
+        page_id = page["_id"]
+        url = page.get("url", "")
+        # Prefer stored title; fallback to url if empty
+        title = page.get("title") or url
+
+        # Prefer full text for indexing. If missing, try snippet.
+        # Ensure we have a string to tokenize.
+        text = page.get("text")
+        if text is None:
+            text = page.get("snippet", "")
+        if text is None:
+            text = ""
+
+        # Defensive: skip tiny or empty documents (avoids noise)
+        if not isinstance(text, str) or len(text.strip()) < 50:
+            # store docs metadata but don't index tokens for tiny docs
+            return None
+
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+
+        # store snippet preferentially: page.snippet else first 300 chars of text
+        snippet = page.get("snippet")
+        if not snippet:
+            snippet = text[:300]
+
+        meta = {
+            "page_id": page_id,
+            "url": url,
+            "title": title,
+            "snippet": snippet,
+            "favicon": page.get("favicon", ""),
+            "site_name": page.get("site_name", ""),
+            "image": page.get("image", "")
+        }
+
+        return len(tokens), Counter(tokens), meta
+
+    except KeyError as e:
+        print("Skipping doc due to missing key:", e)
+        return None
+    except Exception as e:
+        print("Unexpected error while processing a page, skipping:", e)
+        return None
+
+
 def build_index():
+    # The client is created here rather than at import time: the tokenizer
+    # pool spawns fresh interpreters that re-import this module, and they
+    # must not each open their own connection.
+    client = MongoClient(MONGO_URI)
+    db = client[MONGO_DB_NAME]
+    pages_coll = db["pages"]
+    docs_coll = db["documents"]
+    index_coll = db["index_terms"]
+    index_meta_coll = db["index_meta"]
+
     print("Fetching pages from MongoDB...")
 
     # Request snippet + text + title + url (and optional content_type if you stored it)
@@ -58,7 +119,7 @@ def build_index():
     }
 
     try:
-        cursor = PAGES_COLL.find({}, projection)
+        cursor = pages_coll.find({}, projection)
     except PyMongoError as e:
         print("Failed to query pages collection:", e)
         return
@@ -79,60 +140,28 @@ def build_index():
 
     print(f"Found {len(pages)} pages. Building index...")
 
-    inverted_index = defaultdict(lambda: defaultdict(int))
+    # term -> [(doc_id, tf), ...]; each page contributes at most once per term
+    inverted_index: dict[str, list] = {}
     doc_lengths = {}
     doc_metadata = {}
 
-    for page in pages:
-        try:
-            doc_id = page["_id"]
-            url = page.get("url", "")
-            # Prefer stored title; fallback to url if empty
-            title = page.get("title") or url
-
-            # Prefer full text for indexing. If missing, try snippet.
-            # Ensure we have a string to tokenize.
-            text = page.get("text")
-            if text is None:
-                text = page.get("snippet", "")
-            if text is None:
-                text = ""
-
-            # Defensive: skip tiny or empty documents (avoids noise)
-            if not isinstance(text, str) or len(text.strip()) < 50:
-                # store docs metadata but don't index tokens for tiny docs
-                continue
-
-            tokens = tokenize(text)
-            if not tokens:
+    # Tokenizing is CPU-bound and independent per page, so farm it out to
+    # worker processes and only merge the per-page counts here. Always spawn:
+    # forking after the MongoClient has started its monitor threads isn't
+    # safe, and the platform default differs between Python versions.
+    with mp.get_context("spawn").Pool() as pool:
+        for result in pool.imap_unordered(process_page, pages, chunksize=64):
+            if result is None:
                 continue
+            length, tf_counter, meta = result
 
-            doc_lengths[doc_id] = len(tokens)
-            # store snippet preferentially: page.snippet else first 300 chars of text
-            snippet = page.get("snippet")
-            if not snippet:
-                snippet = text[:300]
-
-            doc_metadata[doc_id] = {
-                "url": url,
-                "title": title,
-                "snippet": snippet,
-                "favicon": page.get("favicon", ""),
-                "site_name": page.get("site_name", ""),
-                "image": page.get("image", "")
-            }
-
-
-            tf_counter = Counter(tokens)
+            # Dense 0..N-1 ids let the API sum scores with np.bincount and
+            # keep postings as plain ints instead of 12-byte ObjectIds.
+            doc_id = len(doc_lengths)
+            doc_lengths[doc_id] = length
+            doc_metadata[doc_id] = meta
             for term, tf in tf_counter.items():
-                inverted_index[term][doc_id] += tf
-
-        except KeyError as e:
-            print("Skipping doc due to missing key:", e)
-            continue
-        except Exception as e:
-            print("Unexpected error while processing a page, skipping:", e)
-            continue
+                inverted_index.setdefault(term, []).append((doc_id, tf))
 
     num_docs = len(doc_lengths)
     print(f"Indexed {num_docs} documents with tokens.")
@@ -145,46 +174,98 @@ def build_index():
     for term, postings in inverted_index.items():
         df = len(postings)
         idf = math.log(num_docs / (1 + df))
+        # Sorted by doc_id so the API can binary-search a term's postings.
+        postings.sort()
+        doc_ids, tfs = zip(*postings)
+        # Column layout packed as little-endian int32 binaries: the API wraps
+        # them with np.frombuffer instead of decoding a BSON array per posting.
+        # doc_ids are stored as gaps from the previous id; gaps and tfs are
+        # small numbers, so zlib shrinks both columns several times over.
+        gaps = np.diff(np.asarray(doc_ids, dtype=POSTING_DTYPE), prepend=0)
         term_entry = {
             "term": term,
-            "idf": float(idf),
-            "docs": [
-                {"doc_id": doc_id, "tf": int(tf)}
-                for doc_id, tf in postings.items()
-            ],
+            # float32 precision is all the API scores with
+            "idf": float(np.float32(idf)),
+            "doc_ids": Binary(zlib.compress(gaps.astype(POSTING_DTYPE).tobytes())),
+            "tfs": Binary(zlib.compress(np.asarray(tfs, dtype=POSTING_DTYPE).tobytes())),
         }
         index_docs.append(term_entry)
 
     print(f"Built index for {len(index_docs)} unique terms.")
 
-    print("Dropping old 'documents' and 'index_terms' collections (if they exist)...")
-    DOCS_COLL.drop()
-    INDEX_COLL.drop()
-
-    print("Inserting documents metadata...")
-    docs_bulk = []
-    for doc_id, meta in doc_metadata.items():
-        docs_bulk.append({
-            "_id": doc_id,
-            "url": meta["url"],
-            "title": meta["title"],
-            "length": doc_lengths[doc_id],
-            "snippet": meta["snippet"],
-            "favicon": meta.get("favicon", ""),
-            "site_name": meta.get("site_name", ""),
-            "image": meta.get("image", "")
-        })
-
-    if docs_bulk:
-        DOCS_COLL.insert_many(docs_bulk)
-    print(f"Inserted {len(docs_bulk)} documents into 'documents' collection.")
-
-    print("Inserting index terms (this may take a moment)...")
-    batch_size = 1000
-    for i in range(0, len(index_docs), batch_size):
-        batch = index_docs[i:i + batch_size]
-        INDEX_COLL.insert_many(batch)
-        print(f"Inserted {i + len(batch)} / {len(index_docs)} index terms...")
+    # Tell the API not to reload from the collections while they're rewritten.
+    index_meta_coll.update_one(
+        {"_id": "current"}, {"$set": {"building": True}}, upsert=True
+    )
+
+    # If the rewrite dies part way, the collections are neither the old index
+    # nor the new one: record that instead of leaving building set forever.
+    try:
+        print("Dropping old 'documents' and 'index_terms' collections (if they exist)...")
+        docs_coll.drop()
+        index_coll.drop()
+
+        print("Inserting documents metadata...")
+        docs_bulk = []
+        for doc_id, meta in doc_metadata.items():
+            docs_bulk.append({
+                "_id": doc_id,
+                "page_id": meta["page_id"],
+                "url": meta["url"],
+                "title": meta["title"],
+                "length": doc_lengths[doc_id],
+                "snippet": meta["snippet"],
+                "favicon": meta.get("favicon", ""),
+                "site_name": meta.get("site_name", ""),
+                "image": meta.get("image", "")
+            })
+
+        if docs_bulk:
+            docs_coll.insert_many(docs_bulk, ordered=False)
+        print(f"Inserted {len(docs_bulk)} documents into 'documents' collection.")
+
+        print("Inserting index terms (this may take a moment)...")
+        # Unordered inserts let the server apply each batch without serializing
+        # on document order; PyMongo still splits a batch at the 16MB limit.
+        batch_size = 5000
+        for i in range(0, len(index_docs), batch_size):
+            batch = index_docs[i:i + batch_size]
+            index_coll.insert_many(batch, ordered=False)
+            print(f"Inserted {i + len(batch)} / {len(index_docs)} index terms...")
+    except BaseException as e:
+        # BaseException so Ctrl-C is recorded too; killed processes can't be.
+        index_meta_coll.update_one(
+            {"_id": "current"},
+            {"$set": {"failed": repr(e)}, "$unset": {"building": ""}},
+        )
+        print("Index build failed, the index collections are incomplete:", e)
+        raise
+
+    print("Creating indexes...")
+    try:
+        # Query-time lookups go through {"term": {"$in": ...}}; without this
+        # every search is a collection scan over index_terms.
+        index_coll.create_index([("term", 1)], unique=True)
+        # The crawler upserts/looks up pages by url.
+        pages_coll.create_index([("url", 1)], unique=True)
+    except PyMongoError as e:
+        print("Failed to create indexes:", e)
+
+    try:
+        # Backs the API's USE_MONGO_TEXT search path.
+        pages_coll.create_index(
+            [("title", "text"), ("text", "text")],
+            weights={"title": 10, "text": 1},
+        )
+    except PyMongoError as e:
+        print("Failed to create text index on pages:", e)
+
+    # Publish last: the API reloads its in-memory copy when this changes.
+    index_meta_coll.replace_one(
+        {"_id": "current"},
+        {"_id": "current", "version": ObjectId(), "num_docs": num_docs},
+        upsert=True,
+    )
 
     print("Index build complete ✅")
 